@@ -4,8 +4,14 @@
 
 import json
 import traceback
-from openai import OpenAI
+import threading
 import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import tempfile
 from pathlib import Path
 import html
@@ -16,6 +22,10 @@ from save3 import svg_to_image
 # 配置文件路径
 CONFIG_FILE = 'config.json'
 
+# 已创建的 OpenAI 客户端，按 (api_key, base_url) 复用，保持连接池
+_clients = {}
+_clients_lock = threading.Lock()
+
 def load_config():
     """从配置文件加载配置"""
     try:
@@ -31,6 +41,47 @@ def split_long_text(text, chunk_size=2000):
     """将长文本分割成多个小段"""
     return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
 
+def get_client(config):
+    """
+    获取（或创建）OpenAI 客户端
+
+    openai 及其依赖较重，首次使用时才导入；同一组密钥和地址复用同一个客户端。
+    """
+    key = (config.get('api_key', ""), config.get('base_url', ""))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=key[0], base_url=key[1])
+            _clients[key] = client
+        return client
+
+def warm_up(config=None):
+    """
+    预热 OpenAI 连接：导入依赖、创建客户端并建立到API服务器的连接
+
+    返回:
+        bool: 预热是否成功
+    """
+    if config is None:
+        config = load_config()
+    try:
+        client = get_client(config)
+        client.models.list()
+        return True
+    except Exception as e:
+        print("预热 OpenAI 连接失败:", e)
+        return False
+
+def get_prompt(config, prompt_type=None):
+    """根据prompt_type从配置中选择系统提示词"""
+    if prompt_type == 'ds':
+        return config.get('prompt_ds', "")
+    elif prompt_type == 'hh':
+        return config.get('prompt_hh', "")
+    else:
+        return config.get('prompt', "")
+
 def deepseek_chat(message, model=None, stream=True, prompt=None, config=None, prompt_type=None):
     """
     调用 DeepSeek API 获取对话回复
@@ -51,24 +102,15 @@ def deepseek_chat(message, model=None, stream=True, prompt=None, config=None, pr
     
     # 根据prompt_type选择不同的提示词
     if prompt is None:
-        if prompt_type == 'ds':
-            prompt = config.get('prompt_ds', "")
-        elif prompt_type == 'hh':
-            prompt = config.get('prompt_hh', "")
-        else:
-            prompt = config.get('prompt', "")
+        prompt = get_prompt(config, prompt_type)
     
     # 如果未指定模型或提示词，则使用配置中的默认值
     if model is None:
         model = config.get('model1', "")
     
-    # 初始化 OpenAI 客户端
-    client = OpenAI(
-        api_key=config.get('api_key', ""),
-        base_url=config.get('base_url', "")
-    )
-    
     try:
+        # 获取 OpenAI 客户端
+        client = get_client(config)
         response = client.chat.completions.create(
             model=model,
             messages=[
@@ -134,8 +176,271 @@ def send_message(message, model=None, stream=False, prompt_type=None):
         print(traceback.format_exc())
         return ["API返回错误，请稍后再试"]
 
+class AdaptiveLimiter:
+    """
+    自适应并发限制
+
+    收到429（请求过多）时并发上限减半，连续成功后逐步恢复到最大并发数。
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.active = 0
+        self.successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, stop=None):
+        """获取一个并发名额；stop被设置时放弃等待并返回False"""
+        with self._cond:
+            while self.active >= self.limit and not (stop and stop.is_set()):
+                self._cond.wait()
+            if stop and stop.is_set():
+                return False
+            self.active += 1
+            return True
+
+    def wake(self):
+        """唤醒所有等待名额的线程，使其重新检查stop"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.active -= 1
+            if throttled:
+                if self.limit > 1:
+                    print(f"请求被限流，并发数降为 {max(1, self.limit // 2)}")
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self._cond.notify_all()
+
+def _error_status(error):
+    """从 openai 异常中取出HTTP状态码，没有时返回None（如连接错误）"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+def _retry_after(error):
+    """读取响应头中的 Retry-After（秒），没有时返回None"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def _answer_item(item, config, limiter, stop, max_retries=5):
+    """
+    请求一条批量任务的回复，限流和服务端错误时按指数退避重试
+
+    不会抛出异常：任何错误都以 status="error" 的结果返回，保证其他任务的结果能正常写出。
+    stop被设置后不再发起新的请求或重试，立即返回已取消的结果。
+    """
+    message = item.get('prompt', "")
+    model = item.get('model') or config.get('model1', "")
+    prompt_type = item.get('prompt_type')
+    result = {"id": item["id"], "prompt": message, "model": model, "prompt_type": prompt_type}
+    start = time.perf_counter()
+
+    try:
+        # 关闭客户端自带的重试，由这里统一退避，限流信号才能反馈到并发控制
+        client = get_client(config).with_options(max_retries=0)
+    except Exception as e:
+        result.update(status="error", error=str(e), elapsed_ms=0)
+        return result
+
+    for attempt in range(max_retries + 1):
+        if stop.is_set() or not limiter.acquire(stop):
+            result.update(status="error", error="已取消")
+            break
+        try:
+            response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": get_prompt(config, prompt_type)},
+                    {"role": "user", "content": message},
+                ],
+                stream=False
+            )
+        except Exception as e:
+            status = _error_status(e)
+            throttled = status == 429
+            limiter.release(throttled)
+            retriable = status is None or throttled or status >= 500
+            if not retriable or attempt == max_retries:
+                result.update(status="error", error=str(e))
+                break
+            delay = _retry_after(e) or min(60, 2 ** attempt) + random.uniform(0, 1)
+            if stop.wait(delay):
+                result.update(status="error", error="已取消")
+                break
+            continue
+        limiter.release()
+        try:
+            reply = response.choices[0].message.content
+        except Exception as e:
+            # 返回200但内容格式异常，重试通常也无济于事
+            result.update(status="error", error=f"无法解析API响应: {e}")
+            break
+        result.update(status="ok", reply=(reply or "").strip())
+        break
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000)
+    return result
+
+def _default_item_id(item):
+    """根据prompt、model和prompt_type生成任务ID，输入文件增删行后仍保持不变"""
+    key = json.dumps([item.get('prompt'), item.get('model'), item.get('prompt_type')], ensure_ascii=False)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def load_batch_items(input_path):
+    """
+    读取批量任务JSONL文件，每行包含prompt及可选的id、model、prompt_type
+
+    未指定id时根据内容生成；断点续跑依赖id，重复的id只保留第一条。
+    """
+    items = []
+    seen_ids = set()
+    with open(input_path, 'r', encoding='utf-8') as file:
+        for line_no, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"第{line_no}行不是有效的JSON，已跳过: {e}")
+                continue
+            if not isinstance(item, dict):
+                print(f"第{line_no}行不是JSON对象，已跳过")
+                continue
+            if not item.get('prompt'):
+                print(f"第{line_no}行缺少prompt，已跳过")
+                continue
+            if 'id' not in item:
+                item['id'] = _default_item_id(item)
+            elif isinstance(item['id'], bool) or not isinstance(item['id'], (str, int)):
+                print(f"第{line_no}行的id必须是字符串或整数，已跳过")
+                continue
+            if item['id'] in seen_ids:
+                print(f"第{line_no}行的id {item['id']} 与前面的任务重复，已跳过")
+                continue
+            seen_ids.add(item['id'])
+            items.append(item)
+    return items
+
+def load_finished_ids(output_path):
+    """读取已有结果文件中成功完成的任务ID，用于断点续跑"""
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次中断时可能留下不完整的最后一行
+                continue
+            if result.get('status') == 'ok':
+                finished.add(result.get('id'))
+    return finished
+
+def _ensure_trailing_newline(path):
+    """上次运行中断时结果文件可能停在半行，追加前补上换行，避免新结果与残行粘连"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb+') as file:
+        file.seek(-1, os.SEEK_END)
+        if file.read(1) != b"\n":
+            file.write(b"\n")
+
+def batch_answer(input_path, output_path, concurrency=4, config=None, max_retries=5):
+    """
+    批量生成回复
+
+    参数:
+        input_path (str): 输入JSONL文件，每行形如 {"id": ..., "prompt": ..., "model": ..., "prompt_type": ...}
+        output_path (str): 结果JSONL文件，每完成一条立即追加写入；重新运行时跳过已成功的任务
+        concurrency (int): 最大并发请求数，遇到429时自动降低
+        config (dict): 配置字典，如果为None则从文件加载
+        max_retries (int): 单条任务遇到限流或服务端错误时的最大重试次数
+
+    返回:
+        dict: 统计信息，包含 total、skipped、ok、error
+    """
+    if config is None:
+        config = load_config()
+
+    items = load_batch_items(input_path)
+    finished = load_finished_ids(output_path)
+    todo = [item for item in items if item['id'] not in finished]
+    stats = {"total": len(items), "skipped": len(items) - len(todo), "ok": 0, "error": 0}
+    print(f"共 {stats['total']} 条任务，已完成 {stats['skipped']} 条，本次处理 {len(todo)} 条")
+    if not todo:
+        return stats
+
+    limiter = AdaptiveLimiter(concurrency)
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=limiter.max_concurrency)
+    _ensure_trailing_newline(output_path)
+    with open(output_path, 'a', encoding='utf-8') as output:
+        futures = {pool.submit(_answer_item, item, config, limiter, stop, max_retries): item for item in todo}
+        written = set()
+
+        def write_result(future):
+            """把一条已完成任务的结果追加到结果文件"""
+            try:
+                result = future.result()
+            except Exception as e:
+                item = futures[future]
+                result = {"id": item["id"], "prompt": item.get('prompt', ""), "status": "error",
+                          "error": str(e), "elapsed_ms": 0}
+            written.add(future)
+            stats[result["status"]] += 1
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            print(f"[{len(written)}/{len(todo)}] {result['id']} {result['status']} {result['elapsed_ms']}ms")
+
+        try:
+            for future in as_completed(futures):
+                write_result(future)
+        except BaseException:
+            # 出错或Ctrl-C：取消尚未开始的任务，保存已完成的结果，下次运行可从断点继续
+            print("批量处理中断，取消尚未开始的任务，等待进行中的请求完成...")
+            stop.set()
+            limiter.wake()
+            pool.shutdown(wait=True, cancel_futures=True)
+            for future in futures:
+                if future.done() and not future.cancelled() and future not in written:
+                    write_result(future)
+            print(f"已保存 {len(written)} 条结果，重新运行相同命令可继续处理")
+            raise
+        finally:
+            pool.shutdown(wait=True)
+
+    print(f"批量处理完成: 成功 {stats['ok']} 条，失败 {stats['error']} 条")
+    return stats
+
 # 简单的命令行测试
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat API 测试与批量生成回复")
+    parser.add_argument("--batch", metavar="INPUT", help="批量任务JSONL文件")
+    parser.add_argument("--output", default="batch_results.jsonl", help="结果JSONL文件（支持断点续跑）")
+    parser.add_argument("--concurrency", type=int, default=None, help="最大并发请求数")
+    parser.add_argument("--max-retries", type=int, default=5, help="限流或服务端错误时的最大重试次数")
+    args = parser.parse_args()
+
+    if args.batch:
+        config = load_config()
+        concurrency = args.concurrency or config.get('batch_concurrency', 4)
+        stats = batch_answer(args.batch, args.output, concurrency, config, args.max_retries)
+        sys.exit(1 if stats["error"] else 0)
+
     print("Chat API 测试")
 
     response = send_message("为什么你要这样做？", model="anthropic/claude-3.7-sonnet")
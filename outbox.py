@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# outbox.py - 待发送回复的持久化发件箱
+# 以追加写的JSONL日志记录AI回复、发送进度和已处理消息ID，批量fsync（group commit）
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 默认发件箱日志文件
+OUTBOX_FILE = 'outbox.jsonl'
+
+class Outbox:
+    """
+    崩溃安全的发件箱
+
+    日志中的每一行是一条记录:
+        {"op": "reply", "id": ..., "room_id": ..., "sender": ..., "reply": ..., "ts": ...}
+        {"op": "sent", "id": ..., "step": ...}
+        {"op": "done", "id": ...}
+
+    写入由后台线程统一刷盘，同一批次内的多条记录只做一次fsync。
+    日志行数明显多于有效记录时，后台线程会把日志压缩为当前状态的快照。
+    """
+
+    def __init__(self, path=OUTBOX_FILE, flush_interval=0.05, max_batch=64, max_processed=1000):
+        """
+        参数:
+            path (str): 日志文件路径
+            flush_interval (float): 两次刷盘之间的最长等待时间（秒）
+            max_batch (int): 积累到多少条记录时立即刷盘
+            max_processed (int): 内存及压缩后日志中保留的已处理消息ID数量
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_processed = max_processed
+
+        # 未完成的回复: msg_id -> 记录（附带已完成的发送步骤集合）
+        self.pending = OrderedDict()
+        # 已处理完成的消息ID（按时间顺序，超出上限时淘汰最早的）
+        self.processed = OrderedDict()
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._next_seq = 0
+        # 已确认写入磁盘的最大序号
+        self._durable_seq = 0
+        # 最近一次写入失败的批次中的最大序号及错误
+        self._error_seq = 0
+        self._error = None
+        self._waiters = 0
+        self._closed = False
+
+        self._file = None
+        # 最后一次成功fsync后的文件长度，写入失败时截断到这里，避免残留半行记录
+        self._good_offset = 0
+        self._dirty = False
+        self._lines = 0
+
+        self._load()
+        self._compact()
+
+        self._thread = threading.Thread(target=self._flush_loop, name="outbox-flush", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        """读取已有日志，重建内存状态；末尾被截断的记录直接忽略"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"发件箱日志存在不完整记录，已忽略: {line[:100]}...")
+                        continue
+                    self._apply(record)
+        except Exception as e:
+            print(f"加载发件箱日志失败: {e}")
+
+    def _apply(self, record):
+        """将一条日志记录应用到内存状态"""
+        op = record.get("op")
+        msg_id = record.get("id")
+        if op == "reply":
+            entry = dict(record)
+            entry["sent"] = set(record.get("sent", []))
+            # 同一回复的记录可能被重复写入（如压缩后重试），保留已完成的发送步骤
+            previous = self.pending.get(msg_id)
+            if previous is not None:
+                entry["sent"] |= previous["sent"]
+            self.pending[msg_id] = entry
+        elif op == "sent":
+            entry = self.pending.get(msg_id)
+            if entry is not None:
+                entry["sent"].add(record.get("step"))
+        elif op == "done":
+            self.pending.pop(msg_id, None)
+            self._mark_processed(msg_id)
+
+    def _mark_processed(self, msg_id):
+        self.processed[msg_id] = True
+        self.processed.move_to_end(msg_id)
+        while len(self.processed) > self.max_processed:
+            self.processed.popitem(last=False)
+
+    def _snapshot(self):
+        """把当前内存状态序列化为日志行"""
+        lines = [json.dumps({"op": "done", "id": msg_id}, ensure_ascii=False) + "\n" for msg_id in self.processed]
+        for entry in self.pending.values():
+            record = {k: v for k, v in entry.items() if k != "sent"}
+            record["sent"] = sorted(entry["sent"])
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        return lines
+
+    def _compact(self):
+        """
+        只保留未完成的回复和最近的已处理ID，原子替换日志文件
+
+        运行期间由后台线程在持有锁时调用：快照已包含队列中所有记录的效果，
+        因此替换成功后队列可以直接丢弃并视为已持久化。返回是否成功。
+        """
+        tmp_path = f"{self.path}.tmp"
+        lines = self._snapshot()
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                file.write("".join(lines))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"压缩发件箱日志失败: {e}")
+            if self._file is None:
+                self._open()
+            return False
+
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception as e:
+                print(f"关闭发件箱日志失败: {e}")
+        self._open()
+        self._lines = len(lines)
+        try:
+            # 目录项也需要落盘，否则断电后可能恢复成替换前的旧文件
+            self._fsync_dir()
+        except Exception as e:
+            # 新文件已生效但替换未确认持久化，队列中的记录仍需照常写入
+            print(f"同步发件箱日志目录失败: {e}")
+            return False
+        return True
+
+    def _fsync_dir(self):
+        """fsync日志所在目录，使文件的创建和替换持久化"""
+        if not hasattr(os, "O_DIRECTORY"):
+            # Windows 不支持打开目录进行fsync
+            return
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _open(self):
+        """以无缓冲追加模式打开日志文件"""
+        created = not os.path.exists(self.path)
+        self._file = open(self.path, 'ab', buffering=0)
+        if created:
+            self._fsync_dir()
+        self._good_offset = os.fstat(self._file.fileno()).st_size
+        self._dirty = False
+
+    def _write_batch(self, batch):
+        """写入一批记录并fsync，成功返回None，失败返回异常"""
+        try:
+            if self._dirty:
+                # 上次写入失败可能留下半行记录，先截断到最后一次成功写入的位置
+                os.ftruncate(self._file.fileno(), self._good_offset)
+                self._dirty = False
+            data = "".join(line for _, line in batch).encode('utf-8')
+            view = memoryview(data)
+            while view:
+                written = self._file.write(view)
+                view = view[written:]
+            os.fsync(self._file.fileno())
+        except Exception as e:
+            self._dirty = True
+            print(f"写入发件箱日志失败: {e}")
+            return e
+        self._good_offset += len(data)
+        self._lines += len(batch)
+        return None
+
+    def _flush_loop(self):
+        """后台刷盘线程：攒批写入后统一fsync，然后唤醒等待持久化的调用方"""
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                # 没有调用方在等待持久化时，给同一时间段内的其他写入者一个搭便车的机会；
+                # 有等待者时立即刷盘，fsync期间到达的记录自然并入下一批
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._queue) < self.max_batch and not self._closed and not self._waiters:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue
+                self._queue = []
+                closed = self._closed
+            error = self._write_batch(batch) if batch else None
+            with self._cond:
+                if batch and error is None:
+                    self._durable_seq = batch[-1][0]
+                    self._error = None
+                    # 日志中的冗余记录过多时压缩为当前状态的快照
+                    if self._lines > 2 * (len(self.pending) + self.max_processed) and self._compact():
+                        self._queue = []
+                        self._durable_seq = self._next_seq
+                elif batch:
+                    # 写入失败：通知等待者，并把这批记录放回队列稍后重试
+                    self._error = error
+                    self._error_seq = batch[-1][0]
+                    if not closed:
+                        self._queue = batch + self._queue
+                self._cond.notify_all()
+            if closed:
+                return
+            if error is not None:
+                time.sleep(self.flush_interval)
+
+    def _append(self, record, durable=False):
+        """
+        应用并追加一条记录；durable为True时等待它被fsync后再返回
+
+        写入失败时抛出OSError，记录仍保留在内存中并在后台继续重试写入。
+        """
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._cond:
+            self._apply(record)
+            if self._closed:
+                return
+            self._next_seq += 1
+            seq = self._next_seq
+            self._queue.append((seq, line))
+            if not durable:
+                if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+                    self._cond.notify_all()
+                return
+            self._waiters += 1
+            self._cond.notify_all()
+            try:
+                while self._durable_seq < seq and self._thread.is_alive():
+                    if self._error_seq >= seq:
+                        raise OSError(f"发件箱日志写入失败: {self._error}")
+                    self._cond.wait(self.flush_interval * 4)
+            finally:
+                self._waiters -= 1
+
+    def is_processed(self, msg_id):
+        """消息是否已经生成过回复（无论是否发送完成）"""
+        with self._cond:
+            return msg_id in self.processed or msg_id in self.pending
+
+    def record_reply(self, msg_id, room_id, sender, reply):
+        """
+        持久化一条AI回复，返回待发送记录；返回时回复已写入磁盘
+
+        写入磁盘失败时抛出OSError，此时回复只保存在内存中。
+        """
+        self._append({
+            "op": "reply",
+            "id": msg_id,
+            "room_id": room_id,
+            "sender": sender,
+            "reply": reply,
+            "ts": int(time.time()),
+        }, durable=True)
+        return self.pending[msg_id]
+
+    def is_sent(self, msg_id, step):
+        """某条回复的某个发送步骤是否已完成"""
+        with self._cond:
+            entry = self.pending.get(msg_id)
+            return entry is not None and step in entry["sent"]
+
+    def mark_sent(self, msg_id, step):
+        """记录某个发送步骤已完成（不等待刷盘，崩溃时最多重复发送这一步）"""
+        self._append({"op": "sent", "id": msg_id, "step": step})
+
+    def mark_done(self, msg_id):
+        """记录回复已全部发送完成"""
+        self._append({"op": "done", "id": msg_id})
+
+    def pending_replies(self):
+        """返回尚未发送完成的回复"""
+        with self._cond:
+            return list(self.pending.values())
+
+    def close(self):
+        """刷出剩余记录并停止后台线程"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        try:
+            self._file.close()
+        except Exception as e:
+            print(f"关闭发件箱日志失败: {e}")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# tracing.py - 消息追踪与在线性能分析
+# 记录单条消息从接收到发送完成各阶段的耗时，并支持通过信号在运行中开启性能分析
+
+import cProfile
+import json
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+# 当前线程正在追踪的消息
+_local = threading.local()
+
+class MessageTrace:
+    """单条消息的追踪记录，由若干个带耗时的阶段（span）组成"""
+
+    def __init__(self, msg_id):
+        self.msg_id = msg_id
+        self.start = time.perf_counter()
+        self.spans = []
+        # 为True时无论耗时多少都输出追踪结果（目标消息）
+        self.keep = False
+
+    def add_span(self, name, seconds, **extra):
+        span = {"name": name, "ms": round(seconds * 1000, 1)}
+        span.update(extra)
+        self.spans.append(span)
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.start) * 1000, 1)
+
+    def to_dict(self):
+        return {
+            "id": self.msg_id,
+            "datetime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "total_ms": self.total_ms(),
+            "spans": self.spans,
+        }
+
+def current():
+    """返回当前线程正在追踪的消息，没有时返回None"""
+    return getattr(_local, "trace", None)
+
+def keep():
+    """标记当前消息需要输出追踪结果"""
+    trace = current()
+    if trace is not None:
+        trace.keep = True
+
+@contextmanager
+def span(name, **extra):
+    """记录一个阶段的耗时；没有正在追踪的消息时什么也不做"""
+    trace = current()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        extra["error"] = str(e)
+        raise
+    finally:
+        trace.add_span(name, time.perf_counter() - start, **extra)
+
+@contextmanager
+def trace_message(msg_id, config=None):
+    """
+    追踪一条消息的处理过程
+
+    结束时如果消息被标记为目标消息，或总耗时超过trace_slow_ms（默认1000毫秒），
+    则打印各阶段耗时；配置了trace_file时同时追加写入该JSONL文件。
+    """
+    config = config or {}
+    previous = current()
+    trace = MessageTrace(msg_id)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+        total_ms = trace.total_ms()
+        if trace.keep or total_ms >= config.get("trace_slow_ms", 1000):
+            summary = " | ".join(f"{s['name']} {s['ms']}ms" for s in trace.spans)
+            print(f"[trace] 消息 {msg_id} 总耗时 {total_ms}ms: {summary}")
+            trace_file = config.get("trace_file")
+            if trace_file:
+                try:
+                    with open(trace_file, 'a', encoding='utf-8') as file:
+                        file.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+                except Exception as e:
+                    print(f"写入追踪记录失败: {e}")
+
+class Profiler:
+    """
+    运行中按需开启的性能分析器
+
+    mode为'cprofile'时在主线程上启用cProfile，到时后通过SIGALRM在主线程中停止；
+    mode为'sample'时由后台线程定时采样所有线程的调用栈，输出可用于生成火焰图的折叠栈格式。
+    """
+
+    def __init__(self, mode="cprofile", seconds=30, output_dir="profiles", interval=0.01):
+        self.mode = mode
+        self.seconds = seconds
+        self.output_dir = output_dir
+        self.interval = interval
+        self._profile = None
+        self._sampler = None
+        self._stop_event = None
+
+    @property
+    def running(self):
+        return self._profile is not None or self._sampler is not None
+
+    def toggle(self, *args):
+        """信号处理函数：未运行时开始分析，运行中再次触发则提前结束并输出结果"""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _output_path(self, suffix):
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return os.path.join(self.output_dir, f"profile_{timestamp}_{os.getpid()}.{suffix}")
+
+    def start(self):
+        if self.mode == "sample":
+            self._stop_event = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, name="stack-sampler", daemon=True)
+            self._sampler.start()
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            if hasattr(signal, "SIGALRM"):
+                signal.signal(signal.SIGALRM, lambda *args: self.stop())
+                signal.alarm(max(1, int(self.seconds)))
+        print(f"性能分析已开始 ({self.mode}, {self.seconds}秒)")
+
+    def stop(self):
+        try:
+            if self._sampler is not None:
+                self._stop_event.set()
+                return
+            if self._profile is None:
+                return
+            if hasattr(signal, "SIGALRM"):
+                signal.alarm(0)
+            profile, self._profile = self._profile, None
+            profile.disable()
+            path = self._output_path("prof")
+            profile.dump_stats(path)
+            print(f"性能分析结果已保存: {path}")
+            stats = pstats.Stats(profile, stream=sys.stdout)
+            stats.sort_stats("cumulative").print_stats(20)
+        except Exception as e:
+            print(f"保存性能分析结果失败: {e}")
+
+    def _sample(self):
+        """后台采样线程：定时记录所有其他线程的调用栈"""
+        counts = Counter()
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline and not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                counts[";".join(reversed(stack))] += 1
+        try:
+            path = self._output_path("folded")
+            with open(path, 'w', encoding='utf-8') as file:
+                for stack, count in counts.most_common():
+                    file.write(f"{stack} {count}\n")
+            print(f"调用栈采样结果已保存: {path} (共 {sum(counts.values())} 次采样)")
+        except Exception as e:
+            print(f"保存调用栈采样结果失败: {e}")
+        finally:
+            self._sampler = None
+
+def install_profiler(config):
+    """注册SIGUSR1信号：收到信号时开启/结束性能分析，无需停止机器人"""
+    if not hasattr(signal, "SIGUSR1"):
+        print("当前系统不支持SIGUSR1信号，无法启用按需性能分析")
+        return None
+    profiler = Profiler(
+        mode=config.get("profile_mode", "cprofile"),
+        seconds=config.get("profile_seconds", 30),
+        output_dir=config.get("profile_dir", "profiles"),
+    )
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+    print(f"按需性能分析已就绪: kill -USR1 {os.getpid()}")
+    return profiler
@@ -7,12 +7,15 @@ import time
 import requests
 import os
 import re
+import queue
+import threading
+from concurrent.futures import Future
 from datetime import datetime
-import chat  # 导入chat.py模块
 import uuid
 import base64
-from chat import send_message
 from save3 import svg_to_image
+from outbox import Outbox, OUTBOX_FILE
+import tracing
 import sys
 
 # 配置
@@ -66,8 +69,12 @@ def get_message(api_key, block=True):
         print(f"获取消息失败: {e}")
         return None
 
-def subscribe_to_sse(api_key):
-    """订阅微信消息，使用Server-Sent Events (SSE)方式接收持续推送"""
+def subscribe_to_sse(api_key, wait_on_error=True):
+    """
+    订阅微信消息，使用Server-Sent Events (SSE)方式接收持续推送
+
+    wait_on_error为False时连接失败立即返回None，不在这里等待，由调用方决定何时重试。
+    """
     try:
         print("开始SSE订阅消息流...")
         url = f"{API_BASE_URL}/subscribe"
@@ -79,7 +86,8 @@ def subscribe_to_sse(api_key):
         # 检查连接状态
         if response.status_code == 401 or response.status_code == 403:
             print(f"API密钥验证失败，请确保WCF API密钥正确 (状态码: {response.status_code})")
-            time.sleep(5)
+            if wait_on_error:
+                time.sleep(5)
             return None
             
         response.raise_for_status()
@@ -89,17 +97,100 @@ def subscribe_to_sse(api_key):
         return response
     except requests.exceptions.ConnectionError:
         print(f"连接到API服务器失败，请确保API服务 {API_BASE_URL} 可访问")
-        time.sleep(5)
+        if wait_on_error:
+            time.sleep(5)
         return None
     except Exception as e:
         print(f"创建SSE订阅失败: {e}")
         print(f"异常类型: {type(e).__name__}")
         import traceback
         print(f"异常堆栈: {traceback.format_exc()}")
-        time.sleep(2)
+        if wait_on_error:
+            time.sleep(2)
         return None
 
-def process_sse_events(response, config, messages):
+class BufferedSSEResponse:
+    """
+    提前读取SSE事件流的包装
+
+    连接建立后立即在后台线程中读取事件行并缓存，
+    处理函数就绪后通过 iter_lines 按顺序取出，启动期间到达的事件不会丢失。
+    """
+
+    _END = object()
+
+    def __init__(self, response):
+        self.response = response
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._read, name="sse-reader", daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            for line in self.response.iter_lines(decode_unicode=True):
+                self._queue.put(line)
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            self._queue.put(self._END)
+
+    def iter_lines(self, decode_unicode=True):
+        """按顺序返回缓存的事件行，读取线程中的异常在这里重新抛出"""
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self.response.close()
+
+def run_in_background(name, func, *args):
+    """
+    在守护线程中执行func，返回Future
+
+    与ThreadPoolExecutor不同，进程退出时不会等待这些线程，
+    启动检查失败后可以立即退出，不必等慢速的网络请求结束。
+    """
+    future = Future()
+    
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+def timed(timings, name, func, *args):
+    """执行func并把耗时（秒）记录到timings[name]"""
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = time.perf_counter() - start
+
+def report_warm_up(future, timings):
+    """打印OpenAI连接预热的结果"""
+    elapsed = timings.get("AI预热", 0) * 1000
+    error = future.exception()
+    if error is not None:
+        print(f"AI连接预热失败，耗时 {elapsed:.0f}ms: {error}")
+    elif future.result():
+        print(f"AI连接预热完成，耗时 {elapsed:.0f}ms")
+    else:
+        print(f"AI连接预热失败，耗时 {elapsed:.0f}ms，首次调用时将重新连接")
+
+def print_timings(timings):
+    """打印启动各阶段耗时"""
+    print("启动耗时: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in list(timings.items())))
+
+def process_sse_events(response, config, messages, outbox=None):
     """处理SSE事件流"""
     if not response:
         return
@@ -124,16 +215,18 @@ def process_sse_events(response, config, messages):
                             if "id" in data and "type" in data and "sender" in data and "content" in data:
                                 msg = data
                                 
-                                # 保存消息到本地
-                                if "timestamp" not in msg:
-                                    msg["timestamp"] = int(time.time())
-                                if "datetime" not in msg:
-                                    msg["datetime"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                messages.append(msg)
-                                save_messages(messages)
-                                
-                                # 处理消息
-                                process_message(msg, config)
+                                with tracing.trace_message(msg.get("id"), config):
+                                    # 保存消息到本地
+                                    with tracing.span("保存消息"):
+                                        if "timestamp" not in msg:
+                                            msg["timestamp"] = int(time.time())
+                                        if "datetime" not in msg:
+                                            msg["datetime"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                                        messages.append(msg)
+                                        save_messages(messages)
+                                    
+                                    # 处理消息
+                                    process_message(msg, config, outbox)
                             else:
                                 # 可能是心跳或其他类型的事件
                                 print(f"收到非标准消息格式或事件: {data}")
@@ -230,7 +323,7 @@ def is_target_message(msg, group_id, prefix="#真实"):
     
     return True
 
-def process_message(msg, config):
+def process_message(msg, config, outbox=None):
     """处理接收到的消息"""
     # 获取配置信息
     api_key = config.get("api_key", "")  # OpenRouter API密钥
@@ -240,8 +333,16 @@ def process_message(msg, config):
     at_me_prefix = config.get("AtMe", "@")
     
     # 如果不是目标消息，直接返回
-    if not is_target_message(msg, target_group, "#真实"):
+    with tracing.span("过滤"):
+        if not is_target_message(msg, target_group, "#真实"):
+            return
+    
+    # 已经生成过回复的消息不再重复调用AI
+    msg_id = msg.get("id")
+    if outbox is not None and outbox.is_processed(msg_id):
+        print(f"消息已处理过，跳过: {msg_id}")
         return
+    tracing.keep()
     
     print(f"有进来 数据 处理消息: {msg}")
 
@@ -253,27 +354,78 @@ def process_message(msg, config):
     content = msg.get("content", "")
     content = content.replace("#真实", "", 1).strip()
     
+    # 延迟导入chat模块，避免启动时加载openai
+    import chat
+    
     # 调用AI获取回复
     print(f"处理消息: {content}")
     # 发送正在思考的消息
     notify_msg = f"{at_me_prefix}{sender_wxid} 正在思考中..."
-    send_text_message(wcf_api_key, notify_msg, room_id, sender_wxid)
+    with tracing.span("发送:思考提示"):
+        send_text_message(wcf_api_key, notify_msg, room_id, sender_wxid)
     
-    ai_responses = chat.send_message(content)
+    with tracing.span("AI调用"):
+        ai_responses = chat.send_message(content)
     if not ai_responses or len(ai_responses) == 0:
         # 发送错误消息
         error_msg = f"{at_me_prefix}{sender_wxid} 抱歉，AI服务暂时不可用，请稍后再试。"
-        send_text_message(wcf_api_key, error_msg, room_id, sender_wxid)
+        with tracing.span("发送:错误提示"):
+            send_text_message(wcf_api_key, error_msg, room_id, sender_wxid)
         return
     
     ai_reply = ai_responses[0]
     
+    # 先把回复写入发件箱，进程在发送前崩溃时重启后可直接补发，无需再次调用AI
+    entry = {"id": msg_id, "room_id": room_id, "sender": sender_wxid, "reply": ai_reply}
+    if outbox is not None:
+        with tracing.span("发件箱"):
+            try:
+                entry = outbox.record_reply(msg_id, room_id, sender_wxid, ai_reply)
+            except OSError as e:
+                # 写入磁盘失败时仍直接发送回复，只是崩溃后无法补发
+                print(f"回复写入发件箱失败，继续直接发送: {e}")
+                entry = outbox.pending.get(msg_id, entry)
+    
+    deliver_reply(config, entry, outbox)
+
+def deliver_reply(config, entry, outbox=None):
+    """
+    发送一条已生成的AI回复
+
+    每个发送步骤完成后都会记录到发件箱，重放时跳过已完成的步骤。
+    全部步骤成功后将回复标记为完成，否则保留在发件箱中等待下次启动补发。
+    """
+    wcf_api_key = config.get("wcf_api_key", "")  # 微信HTTP API密钥
+    at_me_prefix = config.get("AtMe", "@")
+    
+    msg_id = entry.get("id")
+    room_id = entry.get("room_id", "")
+    sender_wxid = entry.get("sender", "")
+    ai_reply = entry.get("reply", "")
+    
+    def send_step(step, func, *args):
+        """执行一个发送步骤，返回是否成功"""
+        if outbox is not None and outbox.is_sent(msg_id, step):
+            return True
+        with tracing.span(f"发送:{step}"):
+            result = func(*args)
+        if result is None:
+            return False
+        if outbox is not None:
+            outbox.mark_sent(msg_id, step)
+        return True
+    
+    def finish(ok):
+        if ok and outbox is not None:
+            outbox.mark_done(msg_id)
+    
     # 检查回复是否为SVG内容
     if ai_reply and (ai_reply.strip().startswith("<svg") or "<svg " in ai_reply):
         try:
             # 发送一条简短的文本消息通知用户
             notify_msg = f"{at_me_prefix}{sender_wxid} 正在生成图像回复..."
-            send_text_message(wcf_api_key, notify_msg, room_id, sender_wxid)
+            # 这只是进度提示，发送失败不影响回复是否完成
+            send_step("svg_notify", send_text_message, wcf_api_key, notify_msg, room_id, sender_wxid)
             
             # 生成唯一文件名
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -281,18 +433,20 @@ def process_message(msg, config):
             filename = f"ai_response_{timestamp}_{unique_id}.svg"
             
             # 保存SVG文件
-            svg_file_path = svg_to_image(ai_reply, output_dir="output", filename=filename)
+            with tracing.span("SVG处理"):
+                svg_file_path = svg_to_image(ai_reply, output_dir="output", filename=filename)
             
             # 提取SVG前后可能存在的文本
             start_index = ai_reply.find("<svg")
             end_index = ai_reply.rfind("</svg>") + 6
+            ok = True
             
             # 发送SVG前面的文本（如果有）
             if start_index > 0:
                 before_svg = ai_reply[:start_index].strip()
                 if before_svg:
                     before_msg = f"{at_me_prefix}{sender_wxid} {before_svg}"
-                    send_text_message(wcf_api_key, before_msg, room_id, sender_wxid)
+                    ok = send_step("before_svg", send_text_message, wcf_api_key, before_msg, room_id, sender_wxid) and ok
             
             # 尝试发送SVG文件
             try:
@@ -301,7 +455,7 @@ def process_message(msg, config):
                     svg_data = base64.b64encode(svg_file.read()).decode('utf-8')
                 
                 # 发送SVG作为文件
-                send_file(wcf_api_key, svg_data, filename, room_id)
+                ok = send_step("svg", send_file, wcf_api_key, svg_data, filename, room_id) and ok
                 print(f"已发送SVG文件: {svg_file_path}")
                 
                 # 发送SVG后面的文本（如果有）
@@ -309,8 +463,9 @@ def process_message(msg, config):
                     after_svg = ai_reply[end_index:].strip()
                     if after_svg:
                         after_msg = f"{at_me_prefix}{sender_wxid} {after_svg}"
-                        send_text_message(wcf_api_key, after_msg, room_id, sender_wxid)
+                        ok = send_step("after_svg", send_text_message, wcf_api_key, after_msg, room_id, sender_wxid) and ok
                 
+                finish(ok)
                 return
             except Exception as e:
                 print(f"发送SVG文件失败: {e}")
@@ -320,8 +475,9 @@ def process_message(msg, config):
                         image_data = base64.b64encode(img_file.read()).decode('utf-8')
                     
                     # 发送图像
-                    send_image(wcf_api_key, image_data, os.path.basename(svg_file_path), room_id)
+                    ok = send_step("svg", send_image, wcf_api_key, image_data, os.path.basename(svg_file_path), room_id) and ok
                     print(f"已发送SVG作为图像: {svg_file_path}")
+                    finish(ok)
                     return
                 except Exception as e2:
                     print(f"发送SVG作为图像也失败: {e2}")
@@ -333,8 +489,31 @@ def process_message(msg, config):
     reply = f"{at_me_prefix}{sender_wxid} {ai_reply}"
     
     # 发送回复
-    send_result = send_text_message(wcf_api_key, reply, room_id, sender_wxid)
-    print(f"发送回复结果: {send_result}")
+    ok = send_step("text", send_text_message, wcf_api_key, reply, room_id, sender_wxid)
+    print(f"发送回复结果: {ok}")
+    finish(ok)
+
+def replay_outbox(config, outbox):
+    """启动时补发发件箱中未发送完成的回复，不会再次调用AI"""
+    max_age = config.get("outbox_max_age", 86400)
+    pending = outbox.pending_replies()
+    if not pending:
+        return
+    
+    print(f"发件箱中有 {len(pending)} 条未发送完成的回复，开始补发...")
+    now = int(time.time())
+    for entry in pending:
+        msg_id = entry.get("id")
+        if now - entry.get("ts", now) > max_age:
+            print(f"回复已过期，放弃补发: {msg_id}")
+            outbox.mark_done(msg_id)
+            continue
+        try:
+            with tracing.trace_message(msg_id, config) as trace:
+                trace.keep = True
+                deliver_reply(config, entry, outbox)
+        except Exception as e:
+            print(f"补发回复失败: {msg_id}, {e}")
 
 def send_image(api_key, image_data, filename, receiver):
     """发送图片消息"""
@@ -374,6 +553,7 @@ def send_file(api_key, file_data, filename, receiver):
 
 def main():
     """主函数"""
+    startup_begin = time.perf_counter()
     print("微信机器人启动中...")
     print("=" * 50)
     
@@ -406,29 +586,69 @@ def main():
     else:
         print(f"机器人将监听群组: {target_group}")
     
-    # 获取自己的微信ID
+    # 注册SIGUSR1信号，运行中按需开启性能分析
+    tracing.install_profiler(config)
+    
+    # 并发执行启动检查: 获取微信ID、建立SSE订阅、预热OpenAI连接、加载历史消息和发件箱
     print("正在连接微信API服务...")
+    timings = {"配置": time.perf_counter() - startup_begin}
+    preflight_begin = time.perf_counter()
+    
+    def open_sse():
+        response = subscribe_to_sse(wcf_api_key, wait_on_error=False)
+        return BufferedSSEResponse(response) if response else None
+    
+    def close_sse(future):
+        response = None if future.exception() else future.result()
+        if response:
+            response.close()
+    
+    def warm_up_ai():
+        import chat  # 在后台线程中导入，与网络请求并行
+        return chat.warm_up(config)
+    
+    if test_mode:
+        wxid_future = None
+        sse_future = None
+    else:
+        wxid_future = run_in_background("preflight-wxid", timed, timings, "微信ID", get_self_wxid, wcf_api_key)
+        sse_future = run_in_background("preflight-sse", timed, timings, "SSE订阅", open_sse)
+    warm_up_future = run_in_background("preflight-warm-up", timed, timings, "AI预热", warm_up_ai)
+    messages_future = run_in_background("preflight-messages", timed, timings, "历史消息", load_messages)
+    outbox_future = run_in_background("preflight-outbox", timed, timings, "发件箱", Outbox, config.get("outbox_file", OUTBOX_FILE))
     
     if test_mode:
         # 测试模式模拟微信ID
         self_wxid = "test_wxid_123456"
         print("测试模式: 已模拟微信ID")
     else:
-        # 实际获取微信ID
-        self_wxid = get_self_wxid(wcf_api_key)
+        # 实际获取微信ID，失败时立即退出，不等待其他检查
+        self_wxid = wxid_future.result()
         if not self_wxid:
             print("错误: 无法获取微信ID，请检查API密钥是否正确")
+            sse_future.add_done_callback(close_sse)
+            outbox_future.add_done_callback(lambda future: future.exception() or future.result().close())
             return
     
+    messages = messages_future.result()
+    outbox = outbox_future.result()
+    
+    # 不等待AI预热和SSE订阅完成：预热只影响首次调用的速度，SSE连接由监听循环取用
+    warm_up_future.add_done_callback(lambda future: report_warm_up(future, timings))
+    
+    timings["启动检查"] = time.perf_counter() - preflight_begin
+    
     print("-" * 50)
     print(f"机器人微信ID: {self_wxid}")
     print(f"AI模型: {config.get('model1', '未指定')}")
     print(f"消息前缀: #真实")
     print("-" * 50)
-    print("开始监听消息...")
     
-    # 加载历史消息
-    messages = load_messages()
+    # 补发上次未发送完成的回复
+    timed(timings, "补发", replay_outbox, config, outbox)
+    timings["总计"] = time.perf_counter() - startup_begin
+    print_timings(timings)
+    print("开始监听消息...")
     
     max_reconnect_delay = 30
     reconnect_delay = 1
@@ -457,7 +677,8 @@ def main():
             
             # 处理模拟消息
             print("处理模拟消息...")
-            process_message(test_msg, config)
+            with tracing.trace_message(test_msg["id"], config):
+                process_message(test_msg, config, outbox)
             
             print("\n测试模式: 消息处理完成。在实际模式下，程序会继续监听新消息。")
             print("按下Ctrl+C退出程序")
@@ -466,15 +687,22 @@ def main():
             # 实际模式下使用SSE接收消息
             while True:
                 try:
-                    # 创建SSE连接
-                    sse_response = subscribe_to_sse(wcf_api_key)
+                    # 创建SSE连接（首次使用启动时建立的连接）
+                    if sse_future is not None:
+                        future, sse_future = sse_future, None
+                        response = future.result()
+                    else:
+                        response = subscribe_to_sse(wcf_api_key)
                     
-                    if sse_response:
+                    if response:
                         # 重置重连延迟
                         reconnect_delay = 1
                         
-                        # 处理SSE事件流
-                        process_sse_events(sse_response, config, messages)
+                        # 处理SSE事件流；结束或出错后关闭连接，避免后台读取线程继续占用连接并堆积事件
+                        try:
+                            process_sse_events(response, config, messages, outbox)
+                        finally:
+                            response.close()
                     else:
                         # SSE连接失败，延迟后重试
                         reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)
@@ -502,6 +730,7 @@ def main():
         # 保存消息
         save_messages(messages)
         print("已保存所有消息")
+        outbox.close()
         print("程序已退出")
 
 if __name__ == "__main__":